@@ -1,7 +1,7 @@
 from contextlib import contextmanager
 from email.utils import parseaddr
 from fakeldap import MockLDAP
-from typing import (cast, Any, Dict, Iterable,
+from typing import (cast, Any, Collection, Dict, Iterable,
                     Iterator, List, Optional,
                     Tuple, Union, Set)
 
@@ -623,7 +623,7 @@ class ZulipTestCase(TestCase):
         """
         self.assertEqual(self.get_json_error(result, status_code=status_code), msg)
 
-    def assert_length(self, items: List[Any], count: int) -> None:
+    def assert_length(self, items: Collection[Any], count: int) -> None:
         actual_count = len(items)
         if actual_count != count:  # nocoverage
             print('ITEMS:\n')
@@ -1,6 +1,6 @@
 from contextlib import contextmanager
 from typing import (
-    Any, Callable, Dict, Generator, Iterable, Iterator, List, Mapping,
+    Any, Callable, Deque, Dict, Generator, Iterable, Iterator, List, Mapping,
     Optional, Tuple, Union, IO, TypeVar, TYPE_CHECKING
 )
 
@@ -9,8 +9,6 @@ from django.conf import settings
 from django.test import override_settings
 from django.http import HttpResponse, HttpResponseRedirect
 from django.db.migrations.state import StateApps
-from boto.s3.connection import S3Connection
-from boto.s3.bucket import Bucket
 
 import zerver.lib.upload
 from zerver.lib.actions import do_set_realm_property
@@ -40,46 +38,70 @@ from zproject.backends import ExternalAuthResult, ExternalAuthDataDict
 if TYPE_CHECKING:
     # Avoid an import cycle; we only need these for type annotations.
     from zerver.lib.test_classes import ZulipTestCase, MigrationsTestCase
+    # boto is slow to import, so we only do so lazily, at runtime.
+    from boto.s3.bucket import Bucket
+    from boto.s3.connection import S3Connection
 
 import collections
-from unittest import mock
+import functools
+import itertools
 import os
-import re
 import sys
 import time
 import ujson
-from moto import mock_s3_deprecated
+try:
+    import orjson
+except ImportError:  # nocoverage -- orjson is an optional, faster alternative
+    orjson = None
 
-import fakeldap
-import ldap
+@functools.lru_cache(maxsize=None)
+def get_mock_ldap_class() -> Any:
+    # fakeldap and ldap are heavy imports only needed by LDAP tests,
+    # while this module is imported by every test module, so we build
+    # the MockLDAP class lazily on first use.
+    import fakeldap
+    import ldap
 
-class MockLDAP(fakeldap.MockLDAP):
-    class LDAPError(ldap.LDAPError):
-        pass
+    class MockLDAP(fakeldap.MockLDAP):
+        class LDAPError(ldap.LDAPError):
+            pass
 
-    class INVALID_CREDENTIALS(ldap.INVALID_CREDENTIALS):
-        pass
+        class INVALID_CREDENTIALS(ldap.INVALID_CREDENTIALS):
+            pass
 
-    class NO_SUCH_OBJECT(ldap.NO_SUCH_OBJECT):
-        pass
+        class NO_SUCH_OBJECT(ldap.NO_SUCH_OBJECT):
+            pass
 
-    class ALREADY_EXISTS(ldap.ALREADY_EXISTS):
-        pass
+        class ALREADY_EXISTS(ldap.ALREADY_EXISTS):
+            pass
+
+    return MockLDAP
 
 @contextmanager
 def stub_event_queue_user_events(event_queue_return: Any, user_events_return: Any) -> Iterator[None]:
-    with mock.patch('zerver.lib.events.request_event_queue',
-                    return_value=event_queue_return):
-        with mock.patch('zerver.lib.events.get_user_events',
-                        return_value=user_events_return):
-            yield
+    # We swap the module attributes directly, rather than using
+    # mock.patch, because these stubs are entered thousands of times
+    # across the test suite and mock's patcher machinery is far more
+    # expensive than a plain attribute assignment.
+    import zerver.lib.events as events_module
+    old_request_event_queue = events_module.request_event_queue
+    old_get_user_events = events_module.get_user_events
+    events_module.request_event_queue = lambda *args, **kwargs: event_queue_return  # type: ignore[assignment]
+    events_module.get_user_events = lambda *args, **kwargs: user_events_return  # type: ignore[assignment]
+    try:
+        yield
+    finally:
+        events_module.request_event_queue = old_request_event_queue
+        events_module.get_user_events = old_get_user_events
 
 @contextmanager
 def simulated_queue_client(client: Callable[..., Any]) -> Iterator[None]:
     real_SimpleQueueClient = queue_processors.SimpleQueueClient
     queue_processors.SimpleQueueClient = client  # type: ignore[assignment, misc] # https://github.com/JukkaL/mypy/issues/1152
-    yield
-    queue_processors.SimpleQueueClient = real_SimpleQueueClient  # type: ignore[misc] # https://github.com/JukkaL/mypy/issues/1152
+    try:
+        yield
+    finally:
+        queue_processors.SimpleQueueClient = real_SimpleQueueClient  # type: ignore[misc] # https://github.com/JukkaL/mypy/issues/1152
 
 @contextmanager
 def tornado_redirected_to_list(lst: List[Mapping[str, Any]]) -> Iterator[None]:
@@ -90,12 +112,14 @@ def tornado_redirected_to_list(lst: List[Mapping[str, Any]]) -> Iterator[None]:
     # Some code might call process_notification using keyword arguments,
     # so mypy doesn't allow assigning lst.append to process_notification
     # So explicitly change parameter name to 'notice' to work around this problem
-    yield
-    event_queue.process_notification = real_event_queue_process_notification
+    try:
+        yield
+    finally:
+        event_queue.process_notification = real_event_queue_process_notification
 
 class EventInfo:
-    def populate(self, call_args_list: List[Any]) -> None:
-        args = call_args_list[0][0]
+    def populate(self, recorded_events: List[Tuple[Any, Any, Any]]) -> None:
+        args = recorded_events[0]
         self.realm_id = args[0]
         self.payload = args[1]
         self.user_ids = args[2]
@@ -104,65 +128,138 @@ class EventInfo:
 def capture_event(event_info: EventInfo) -> Iterator[None]:
     # Use this for simple endpoints that throw a single event
     # in zerver.lib.actions.
-    with mock.patch('zerver.lib.actions.send_event') as m:
+    import zerver.lib.actions as actions_module
+    recorded_events: List[Tuple[Any, Any, Any]] = []
+
+    def fake_send_event(realm: Any, event: Any, users: Any) -> None:
+        recorded_events.append((realm, event, users))
+
+    old_send_event = actions_module.send_event
+    actions_module.send_event = fake_send_event  # type: ignore[assignment]
+    try:
         yield
+    finally:
+        actions_module.send_event = old_send_event  # type: ignore[assignment]
 
-    if len(m.call_args_list) == 0:
+    if len(recorded_events) == 0:
         raise AssertionError('No event was sent inside actions.py')
 
-    if len(m.call_args_list) > 1:
+    if len(recorded_events) > 1:
         raise AssertionError('Too many events sent by action')
 
-    event_info.populate(m.call_args_list)
+    event_info.populate(recorded_events)
+
+class CacheQueryLog:
+    '''Records the cache lookups attempted under simulated_empty_cache.
+
+    By default we only count the lookups, since tests typically just
+    assert on how many happened; set record=True before exercising
+    the code under test to also capture (operation, key, cache_name)
+    entries, at the cost of a tuple allocation per lookup.
+
+    Note that entries (and thus iterating the log, including the
+    diagnostics assert_length prints on failure) will be empty for
+    lookups made while record was False; the keys aren't saved, so
+    they can't be reconstructed after the fact.'''
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.record = False
+        self.entries: List[Tuple[str, Union[str, List[str]], Optional[str]]] = []
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Tuple[str, Union[str, List[str]], Optional[str]]]:
+        return iter(self.entries)
 
 @contextmanager
-def simulated_empty_cache() -> Generator[
-        List[Tuple[str, Union[str, List[str]], str]], None, None]:
-    cache_queries: List[Tuple[str, Union[str, List[str]], str]] = []
+def simulated_empty_cache() -> Generator[CacheQueryLog, None, None]:
+    cache_queries = CacheQueryLog()
 
     def my_cache_get(key: str, cache_name: Optional[str]=None) -> Optional[Dict[str, Any]]:
-        cache_queries.append(('get', key, cache_name))
+        if cache_queries.record:
+            cache_queries.entries.append(('get', key, cache_name))
+        cache_queries.count += 1
         return None
 
     def my_cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:  # nocoverage -- simulated code doesn't use this
-        cache_queries.append(('getmany', keys, cache_name))
+        if cache_queries.record:
+            cache_queries.entries.append(('getmany', keys, cache_name))
+        cache_queries.count += 1
         return {}
 
     old_get = cache.cache_get
     old_get_many = cache.cache_get_many
     cache.cache_get = my_cache_get
     cache.cache_get_many = my_cache_get_many
-    yield cache_queries
-    cache.cache_get = old_get
-    cache.cache_get_many = old_get_many
+    try:
+        yield cache_queries
+    finally:
+        cache.cache_get = old_get
+        cache.cache_get_many = old_get_many
+
+class CapturedQuery(Dict[str, Any]):
+    '''A single SQL query captured by queries_captured.  The expensive
+    cursor.mogrify call is deferred until the test actually reads
+    query['sql']; most tests only count the captured queries.'''
+
+    def __init__(self, cursor: Any, sql: Query, params: Optional[Params],
+                 time: str) -> None:
+        super().__init__(time=time)
+        self._cursor = cursor
+        self._sql = sql
+        self._params = params
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'sql' and 'sql' not in self:
+            self['sql'] = self._cursor.mogrify(self._sql, self._params).decode('utf-8')
+        return super().__getitem__(key)
+
+    def __repr__(self) -> str:
+        self['sql']  # materialize the query for display
+        return super().__repr__()
 
 @contextmanager
-def queries_captured(include_savepoints: Optional[bool]=False) -> Generator[
-        List[Dict[str, Union[str, bytes]]], None, None]:
+def queries_captured(include_savepoints: Optional[bool]=False,
+                     clear_cache_between_queries: bool=False) -> Generator[
+        List[CapturedQuery], None, None]:
     '''
     Allow a user to capture just the queries executed during
     the with statement.
+
+    We hook at the psycopg2 cursor level, rather than using Django's
+    execute_wrapper API, so that queries issued through SQLAlchemy
+    (which shares the raw connection; see zerver.lib.db) are captured
+    as well.
+
+    The cache backend is left untouched, so values cached before or
+    during the block stay warm and cache hits don't turn into
+    queries; tests that want per-query cache isolation can opt in
+    with clear_cache_between_queries=True, at the cost of a cache
+    round trip per SQL statement.
     '''
 
-    queries: List[Dict[str, Union[str, bytes]]] = []
+    queries: List[CapturedQuery] = []
 
     def wrapper_execute(self: TimeTrackingCursor,
                         action: Callable[[str, ParamsT], None],
                         sql: Query,
                         params: ParamsT) -> None:
-        cache = get_cache_backend(None)
-        cache.clear()
-        start = time.time()
+        if clear_cache_between_queries:
+            get_cache_backend(None).clear()
+        start = time.perf_counter()
         try:
             return action(sql, params)
         finally:
-            stop = time.time()
-            duration = stop - start
+            duration = time.perf_counter() - start
             if include_savepoints or not isinstance(sql, str) or 'SAVEPOINT' not in sql:
-                queries.append({
-                    'sql': self.mogrify(sql, params).decode('utf-8'),
-                    'time': "%.3f" % (duration,),
-                })
+                queries.append(CapturedQuery(
+                    cursor=self,
+                    sql=sql,
+                    params=params,
+                    time="%.3f" % (duration,),
+                ))
 
     old_execute = TimeTrackingCursor.execute
     old_executemany = TimeTrackingCursor.executemany
@@ -177,10 +274,11 @@ def queries_captured(include_savepoints: Optional[bool]=False) -> Generator[
         return wrapper_execute(self, super(TimeTrackingCursor, self).executemany, sql, params)  # nocoverage -- doesn't actually get used in tests
     TimeTrackingCursor.executemany = cursor_executemany  # type: ignore[assignment] # https://github.com/JukkaL/mypy/issues/1167
 
-    yield queries
-
-    TimeTrackingCursor.execute = old_execute  # type: ignore[assignment] # https://github.com/JukkaL/mypy/issues/1167
-    TimeTrackingCursor.executemany = old_executemany  # type: ignore[assignment] # https://github.com/JukkaL/mypy/issues/1167
+    try:
+        yield queries
+    finally:
+        TimeTrackingCursor.execute = old_execute  # type: ignore[assignment] # https://github.com/JukkaL/mypy/issues/1167
+        TimeTrackingCursor.executemany = old_executemany  # type: ignore[assignment] # https://github.com/JukkaL/mypy/issues/1167
 
 @contextmanager
 def stdout_suppressed() -> Iterator[IO[str]]:
@@ -196,34 +294,44 @@ def reset_emails_in_zulip_realm() -> None:
     do_set_realm_property(realm, 'email_address_visibility',
                           Realm.EMAIL_ADDRESS_VISIBILITY_EVERYONE)
 
+TEST_AVATAR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../tests/images'))
+
 def get_test_image_file(filename: str) -> IO[Any]:
-    test_avatar_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../tests/images'))
-    return open(os.path.join(test_avatar_dir, filename), 'rb')
+    return open(os.path.join(TEST_AVATAR_DIR, filename), 'rb')
 
 def avatar_disk_path(user_profile: UserProfile, medium: bool=False, original: bool=False) -> str:
     avatar_url_path = avatar_url(user_profile, medium)
+    head, _, filename = avatar_url_path.rpartition("/")
+    realm_dir = head.rpartition("/")[2]
     avatar_disk_path = os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars",
-                                    avatar_url_path.split("/")[-2],
-                                    avatar_url_path.split("/")[-1].split("?")[0])
+                                    realm_dir, filename.partition("?")[0])
     if original:
-        return avatar_disk_path.replace(".png", ".original")
+        return avatar_disk_path[:-len(".png")] + ".original"
     return avatar_disk_path
 
 def make_client(name: str) -> Client:
     client, _ = Client.objects.get_or_create(name=name)
     return client
 
+CONFIRMATION_URL_PREFIX = "accounts/do_confirm/"
+CONFIRMATION_KEY_LENGTH = 24
+
 def find_key_by_email(address: str) -> Optional[str]:
     from django.core.mail import outbox
-    key_regex = re.compile("accounts/do_confirm/([a-z0-9]{24})>")
     for message in reversed(outbox):
         if address in message.to:
-            return key_regex.search(message.body).groups()[0]
+            # The confirmation key is a fixed-length string right
+            # after the URL prefix, so a substring search plus a slice
+            # is much cheaper than running a regex over the body.
+            i = message.body.find(CONFIRMATION_URL_PREFIX)
+            assert i >= 0
+            start = i + len(CONFIRMATION_URL_PREFIX)
+            return message.body[start:start + CONFIRMATION_KEY_LENGTH]
     return None  # nocoverage -- in theory a test might want this case, but none do
 
 def message_stream_count(user_profile: UserProfile) -> int:
+    # COUNT(*) needs no JOIN, so no select_related here.
     return UserMessage.objects. \
-        select_related("message"). \
         filter(user_profile=user_profile). \
         count()
 
@@ -235,8 +343,10 @@ def most_recent_usermessage(user_profile: UserProfile) -> UserMessage:
     return query[0]  # Django does LIMIT here
 
 def most_recent_message(user_profile: UserProfile) -> Message:
-    usermessage = most_recent_usermessage(user_profile)
-    return usermessage.message
+    query = Message.objects. \
+        filter(usermessage__user_profile=user_profile). \
+        order_by('-id')
+    return query[0]  # Django does LIMIT here
 
 def get_subscription(stream_name: str, user_profile: UserProfile) -> Subscription:
     stream = get_stream(stream_name, user_profile.realm)
@@ -245,16 +355,29 @@ def get_subscription(stream_name: str, user_profile: UserProfile) -> Subscriptio
                                     recipient_id=recipient_id, active=True)
 
 def get_user_messages(user_profile: UserProfile) -> List[Message]:
-    query = UserMessage.objects. \
-        select_related("message"). \
-        filter(user_profile=user_profile). \
-        order_by('message')
-    return [um.message for um in query]
+    # Build the Message rows directly, rather than materializing a
+    # UserMessage object per row just to throw it away.
+    query = Message.objects. \
+        filter(usermessage__user_profile=user_profile). \
+        order_by('id')
+    return list(query)
 
 class DummyHandler:
     def __init__(self) -> None:
         allocate_handler_id(self)  # type: ignore[arg-type] # this is a testing mock
 
+_dummy_handler: Optional[DummyHandler] = None
+
+def _get_dummy_handler() -> DummyHandler:
+    # Share one DummyHandler across all POSTRequestMock objects; each
+    # DummyHandler registers itself in the global Tornado handlers
+    # dict and is never freed, so allocating one per mocked request
+    # would grow that dict for the lifetime of the test run.
+    global _dummy_handler
+    if _dummy_handler is None:
+        _dummy_handler = DummyHandler()
+    return _dummy_handler
+
 class POSTRequestMock:
     method = "POST"
 
@@ -265,12 +388,15 @@ class POSTRequestMock:
         # though of course the HTTP API would do so.  Ideally, we'd
         # get rid of this abstraction entirely and just use the HTTP
         # API directly, but while it exists, we need this code.
-        self.POST: Dict[str, str] = {}
-        for key in post_data:
-            self.POST[key] = str(post_data[key])
+        # Checking type(value) is str skips the no-op str() call in
+        # the common case where the value is already a string.
+        self.POST: Dict[str, str] = {
+            key: value if type(value) is str else str(value)
+            for key, value in post_data.items()
+        }
 
         self.user = user_profile
-        self._tornado_handler = DummyHandler()
+        self._tornado_handler = _get_dummy_handler()
         self._log_data: Dict[str, Any] = {}
         self.META = {'PATH_INFO': 'test'}
         self.path = ''
@@ -294,23 +420,24 @@ class HostRequestMock:
         return self.host
 
 class MockPythonResponse:
+    # Shared by every response constructed without explicit headers;
+    # don't mutate it.
+    _DEFAULT_HEADERS = {'content-type': 'text/html'}
+
     def __init__(self, text: str, status_code: int, headers: Optional[Dict[str, str]]=None) -> None:
         self.text = text
         self.status_code = status_code
-        if headers is None:
-            headers = {'content-type': 'text/html'}
-        self.headers = headers
-
-    @property
-    def ok(self) -> bool:
-        return self.status_code == 200
+        self.ok = status_code == 200
+        self.headers = headers if headers is not None else self._DEFAULT_HEADERS
 
     def iter_content(self, n: int) -> Generator[str, Any, None]:
         yield self.text[:n]
 
 
 INSTRUMENTING = os.environ.get('TEST_INSTRUMENT_URL_COVERAGE', '') == 'TRUE'
-INSTRUMENTED_CALLS: List[Dict[str, Any]] = []
+# A deque has cheaper appends than a list once it grows large, and
+# instrumented runs accumulate one record per HTTP call.
+INSTRUMENTED_CALLS: Deque[Dict[str, Any]] = collections.deque()
 
 UrlFuncT = Callable[..., HttpResponse]  # TODO: make more specific
 
@@ -351,27 +478,65 @@ def write_instrumentation_reports(full_suite: bool, include_webhooks: bool) -> N
         from zproject.urls import urlpatterns, v1_api_and_json_patterns
 
         # Find our untested urls.
-        pattern_cnt: Dict[str, int] = collections.defaultdict(int)
+        all_patterns: List[str] = []
+        matched_patterns: List[str] = []
 
         def re_strip(r: Any) -> str:
             return str(r).lstrip('^').rstrip('$')
 
-        def find_patterns(patterns: List[Any], prefixes: List[str]) -> None:
-            for pattern in patterns:
-                find_pattern(pattern, prefixes)
+        test_server_prefixes = (
+            'http://testserver/',
+            'http://zulip.testserver/',
+            'http://testserver:9080/',
+        )
 
         def cleanup_url(url: str) -> str:
+            # The prefixes are mutually exclusive, so we can stop at
+            # the first one that matches.
             if url.startswith('/'):
-                url = url[1:]
-            if url.startswith('http://testserver/'):
-                url = url[len('http://testserver/'):]
-            if url.startswith('http://zulip.testserver/'):
-                url = url[len('http://zulip.testserver/'):]
-            if url.startswith('http://testserver:9080/'):
-                url = url[len('http://testserver:9080/'):]
+                return url[1:]
+            for prefix in test_server_prefixes:
+                if url.startswith(prefix):
+                    return url[len(prefix):]
             return url
 
-        def find_pattern(pattern: Any, prefixes: List[str]) -> None:
+        CallCandidates = List[Tuple[str, Dict[str, Any]]]
+
+        def find_patterns(patterns: List[Any], prefixes: List[str]) -> None:
+            # Running pattern.resolve for every (pattern, call) pair is
+            # quadratic, and dominates the time spent on this report.
+            # Instead, we clean up and prefix-strip each call's URL
+            # once, bucketing the candidates by their first path
+            # segment; each pattern then only attempts to resolve the
+            # calls that could plausibly match it.
+            buckets: Dict[str, CallCandidates] = collections.defaultdict(list)
+            all_candidates: CallCandidates = []
+            for call in calls:
+                url = cleanup_url(call['url'])
+                for prefix in prefixes:
+                    if url.startswith(prefix):
+                        match_url = url[len(prefix):]
+                        candidate = (match_url, call)
+                        buckets[match_url.split('/', 1)[0]].append(candidate)
+                        all_candidates.append(candidate)
+            for pattern in patterns:
+                find_pattern(pattern, prefixes, buckets, all_candidates)
+
+        regex_metachars = '\\^$.|?*+()[]{}'
+
+        def first_literal_segment(regex_pattern: str) -> Optional[str]:
+            # Returns the first path segment of the pattern if it is
+            # literal text, or None if a regex construct gets in the
+            # way and we can't cheaply tell which calls might match.
+            segment = regex_pattern.split('/', 1)[0]
+            for char in segment:
+                if char in regex_metachars:
+                    return None
+            return segment
+
+        def find_pattern(pattern: Any, prefixes: List[str],
+                         buckets: Dict[str, CallCandidates],
+                         all_candidates: CallCandidates) -> None:
 
             if isinstance(pattern, type(URLResolver)):
                 return  # nocoverage -- shouldn't actually happen
@@ -379,26 +544,32 @@ def write_instrumentation_reports(full_suite: bool, include_webhooks: bool) -> N
             if hasattr(pattern, 'url_patterns'):
                 return
 
-            canon_pattern = prefixes[0] + re_strip(pattern.pattern.regex.pattern)
-            cnt = 0
-            for call in calls:
+            stripped_pattern = re_strip(pattern.pattern.regex.pattern)
+            canon_pattern = prefixes[0] + stripped_pattern
+            segment = first_literal_segment(stripped_pattern)
+            if segment is None:
+                # Patterns whose first segment is itself a regex group
+                # fall back to scanning every call.
+                candidates = all_candidates
+            else:
+                candidates = buckets.get(segment, [])
+            all_patterns.append(canon_pattern)
+            for match_url, call in candidates:
                 if 'pattern' in call:
                     continue
-
-                url = cleanup_url(call['url'])
-
-                for prefix in prefixes:
-                    if url.startswith(prefix):
-                        match_url = url[len(prefix):]
-                        if pattern.resolve(match_url):
-                            if call['status_code'] in [200, 204, 301, 302]:
-                                cnt += 1
-                            call['pattern'] = canon_pattern
-            pattern_cnt[canon_pattern] += cnt
+                if pattern.resolve(match_url):
+                    if call['status_code'] in [200, 204, 301, 302]:
+                        matched_patterns.append(canon_pattern)
+                    call['pattern'] = canon_pattern
 
         find_patterns(urlpatterns, ['', 'en/', 'de/'])
         find_patterns(v1_api_and_json_patterns, ['api/v1/', 'json/'])
 
+        # Counter does the tallying in C; updating with zeroes ensures
+        # patterns with no matches still show up as untested.
+        pattern_cnt: Dict[str, int] = collections.Counter(matched_patterns)
+        pattern_cnt.update({pattern: 0 for pattern in all_patterns})
+
         assert len(pattern_cnt) > 100
         untested_patterns = {p.replace("\\", "") for p in pattern_cnt if pattern_cnt[p] == 0}
 
@@ -421,20 +592,42 @@ def write_instrumentation_reports(full_suite: bool, include_webhooks: bool) -> N
 
         var_dir = 'var'  # TODO make sure path is robust here
         fn = os.path.join(var_dir, 'url_coverage.txt')
-        with open(fn, 'w') as f:
-            for call in calls:
+        if orjson is not None:
+            # orjson serializes small dicts several times faster than
+            # ujson and returns bytes, so no separate encode is needed.
+            dumps: Callable[[Dict[str, Any]], bytes] = orjson.dumps
+        else:
+            def dumps(call: Dict[str, Any]) -> bytes:
+                return ujson.dumps(call).encode()
+
+        with open(fn, 'wb', buffering=1 << 20) as f:
+            # Serialize the calls in chunks of 1000 records, so that
+            # we do one large write per chunk instead of a separate
+            # string concatenation and write per call.
+            calls_iter = iter(calls)
+            while True:
+                chunk = list(itertools.islice(calls_iter, 1000))
+                if not chunk:
+                    break
                 try:
-                    line = ujson.dumps(call)
-                    f.write(line + '\n')
-                except OverflowError:  # nocoverage -- test suite error handling
-                    print('''
-                        A JSON overflow error was encountered while
-                        producing the URL coverage report.  Sometimes
-                        this indicates that a test is passing objects
-                        into methods like client_post(), which is
-                        unnecessary and leads to false positives.
-                        ''')
-                    print(call)
+                    # orjson raises TypeError for non-serializable
+                    # objects, where ujson raises OverflowError.
+                    f.write(b'\n'.join(dumps(call) for call in chunk) + b'\n')
+                except (TypeError, OverflowError):  # nocoverage -- test suite error handling
+                    # Retry the chunk one record at a time, so that
+                    # the diagnostic below identifies the bad call.
+                    for call in chunk:
+                        try:
+                            f.write(dumps(call) + b'\n')
+                        except (TypeError, OverflowError):
+                            print('''
+                                A JSON overflow error was encountered while
+                                producing the URL coverage report.  Sometimes
+                                this indicates that a test is passing objects
+                                into methods like client_post(), which is
+                                unnecessary and leads to false positives.
+                                ''')
+                            print(call)
 
         if full_suite:
             print('INFO: URL coverage report is in %s' % (fn,))
@@ -455,131 +648,144 @@ def load_subdomain_token(response: HttpResponse) -> ExternalAuthDataDict:
 
 FuncT = TypeVar('FuncT', bound=Callable[..., None])
 
+# An S3Connection cached for the duration of a single use_s3_backend
+# test, so that tests creating several buckets don't rebuild the
+# mocked connection each time.  The cache is only valid while
+# use_s3_backend is active: a connection must never be reused across a
+# moto teardown, and tests that apply mock_s3_deprecated directly give
+# us no hook to notice when their mock goes away.
+_s3_backend_connection: Optional['S3Connection'] = None
+_s3_backend_active = False
+
+def _create_s3_connection() -> 'S3Connection':
+    from boto.s3.connection import S3Connection
+    return S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
+
 def use_s3_backend(method: FuncT) -> FuncT:
+    from moto import mock_s3_deprecated
+
     @mock_s3_deprecated
     @override_settings(LOCAL_UPLOADS_DIR=None)
     def new_method(*args: Any, **kwargs: Any) -> Any:
+        global _s3_backend_connection, _s3_backend_active
         zerver.lib.upload.upload_backend = S3UploadBackend()
+        _s3_backend_active = True
         try:
             return method(*args, **kwargs)
         finally:
             zerver.lib.upload.upload_backend = LocalUploadBackend()
+            # mock_s3_deprecated tears down the mocked S3 backend
+            # when this method returns, so the connection created
+            # under it must not outlive it.
+            _s3_backend_active = False
+            _s3_backend_connection = None
     return new_method
 
-def create_s3_buckets(*bucket_names: Tuple[str]) -> List[Bucket]:
-    conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
+def create_s3_buckets(*bucket_names: Tuple[str]) -> List['Bucket']:
+    global _s3_backend_connection
+    if not _s3_backend_active:
+        conn = _create_s3_connection()
+    else:
+        if _s3_backend_connection is None:
+            _s3_backend_connection = _create_s3_connection()
+        conn = _s3_backend_connection
     buckets = [conn.create_bucket(name) for name in bucket_names]
     return buckets
 
 def use_db_models(method: Callable[..., None]) -> Callable[..., None]:  # nocoverage
     def method_patched_with_mock(self: 'MigrationsTestCase', apps: StateApps) -> None:
-        ArchivedAttachment = apps.get_model('zerver', 'ArchivedAttachment')
-        ArchivedMessage = apps.get_model('zerver', 'ArchivedMessage')
-        ArchivedUserMessage = apps.get_model('zerver', 'ArchivedUserMessage')
-        Attachment = apps.get_model('zerver', 'Attachment')
-        BotConfigData = apps.get_model('zerver', 'BotConfigData')
-        BotStorageData = apps.get_model('zerver', 'BotStorageData')
-        Client = apps.get_model('zerver', 'Client')
-        CustomProfileField = apps.get_model('zerver', 'CustomProfileField')
-        CustomProfileFieldValue = apps.get_model('zerver', 'CustomProfileFieldValue')
-        DefaultStream = apps.get_model('zerver', 'DefaultStream')
-        DefaultStreamGroup = apps.get_model('zerver', 'DefaultStreamGroup')
-        EmailChangeStatus = apps.get_model('zerver', 'EmailChangeStatus')
-        Huddle = apps.get_model('zerver', 'Huddle')
-        Message = apps.get_model('zerver', 'Message')
-        MultiuseInvite = apps.get_model('zerver', 'MultiuseInvite')
-        MutedTopic = apps.get_model('zerver', 'MutedTopic')
-        PreregistrationUser = apps.get_model('zerver', 'PreregistrationUser')
-        PushDeviceToken = apps.get_model('zerver', 'PushDeviceToken')
-        Reaction = apps.get_model('zerver', 'Reaction')
-        Realm = apps.get_model('zerver', 'Realm')
-        RealmAuditLog = apps.get_model('zerver', 'RealmAuditLog')
-        RealmDomain = apps.get_model('zerver', 'RealmDomain')
-        RealmEmoji = apps.get_model('zerver', 'RealmEmoji')
-        RealmFilter = apps.get_model('zerver', 'RealmFilter')
-        Recipient = apps.get_model('zerver', 'Recipient')
+        # Fetch all of the zerver models in one registry walk, rather
+        # than calling apps.get_model (which takes the registry lock
+        # and validates the app label) once per model.
+        models = {model.__name__: model
+                  for model in apps.get_app_config('zerver').get_models()}
+
+        Recipient = models['Recipient']
         Recipient.PERSONAL = 1
         Recipient.STREAM = 2
         Recipient.HUDDLE = 3
-        ScheduledEmail = apps.get_model('zerver', 'ScheduledEmail')
-        ScheduledMessage = apps.get_model('zerver', 'ScheduledMessage')
-        Service = apps.get_model('zerver', 'Service')
-        Stream = apps.get_model('zerver', 'Stream')
-        Subscription = apps.get_model('zerver', 'Subscription')
-        UserActivity = apps.get_model('zerver', 'UserActivity')
-        UserActivityInterval = apps.get_model('zerver', 'UserActivityInterval')
-        UserGroup = apps.get_model('zerver', 'UserGroup')
-        UserGroupMembership = apps.get_model('zerver', 'UserGroupMembership')
-        UserHotspot = apps.get_model('zerver', 'UserHotspot')
-        UserMessage = apps.get_model('zerver', 'UserMessage')
-        UserPresence = apps.get_model('zerver', 'UserPresence')
-        UserProfile = apps.get_model('zerver', 'UserProfile')
-
-        zerver_models_patch = mock.patch.multiple(
-            'zerver.models',
-            ArchivedAttachment=ArchivedAttachment,
-            ArchivedMessage=ArchivedMessage,
-            ArchivedUserMessage=ArchivedUserMessage,
-            Attachment=Attachment,
-            BotConfigData=BotConfigData,
-            BotStorageData=BotStorageData,
-            Client=Client,
-            CustomProfileField=CustomProfileField,
-            CustomProfileFieldValue=CustomProfileFieldValue,
-            DefaultStream=DefaultStream,
-            DefaultStreamGroup=DefaultStreamGroup,
-            EmailChangeStatus=EmailChangeStatus,
-            Huddle=Huddle,
-            Message=Message,
-            MultiuseInvite=MultiuseInvite,
-            MutedTopic=MutedTopic,
-            PreregistrationUser=PreregistrationUser,
-            PushDeviceToken=PushDeviceToken,
-            Reaction=Reaction,
-            Realm=Realm,
-            RealmAuditLog=RealmAuditLog,
-            RealmDomain=RealmDomain,
-            RealmEmoji=RealmEmoji,
-            RealmFilter=RealmFilter,
-            Recipient=Recipient,
-            ScheduledEmail=ScheduledEmail,
-            ScheduledMessage=ScheduledMessage,
-            Service=Service,
-            Stream=Stream,
-            Subscription=Subscription,
-            UserActivity=UserActivity,
-            UserActivityInterval=UserActivityInterval,
-            UserGroup=UserGroup,
-            UserGroupMembership=UserGroupMembership,
-            UserHotspot=UserHotspot,
-            UserMessage=UserMessage,
-            UserPresence=UserPresence,
-            UserProfile=UserProfile
-        )
-        zerver_test_helpers_patch = mock.patch.multiple(
-            'zerver.lib.test_helpers',
-            Client=Client,
-            Message=Message,
-            Subscription=Subscription,
-            UserMessage=UserMessage,
-            UserProfile=UserProfile,
-        )
 
-        zerver_test_classes_patch = mock.patch.multiple(
-            'zerver.lib.test_classes',
-            Client=Client,
-            Message=Message,
-            Realm=Realm,
-            Recipient=Recipient,
-            Stream=Stream,
-            Subscription=Subscription,
-            UserProfile=UserProfile,
-        )
-
-        with zerver_models_patch,\
-                zerver_test_helpers_patch,\
-                zerver_test_classes_patch:
+        zerver_models_names = [
+            'ArchivedAttachment',
+            'ArchivedMessage',
+            'ArchivedUserMessage',
+            'Attachment',
+            'BotConfigData',
+            'BotStorageData',
+            'Client',
+            'CustomProfileField',
+            'CustomProfileFieldValue',
+            'DefaultStream',
+            'DefaultStreamGroup',
+            'EmailChangeStatus',
+            'Huddle',
+            'Message',
+            'MultiuseInvite',
+            'MutedTopic',
+            'PreregistrationUser',
+            'PushDeviceToken',
+            'Reaction',
+            'Realm',
+            'RealmAuditLog',
+            'RealmDomain',
+            'RealmEmoji',
+            'RealmFilter',
+            'Recipient',
+            'ScheduledEmail',
+            'ScheduledMessage',
+            'Service',
+            'Stream',
+            'Subscription',
+            'UserActivity',
+            'UserActivityInterval',
+            'UserGroup',
+            'UserGroupMembership',
+            'UserHotspot',
+            'UserMessage',
+            'UserPresence',
+            'UserProfile',
+        ]
+        zerver_test_helpers_names = [
+            'Client',
+            'Message',
+            'Subscription',
+            'UserMessage',
+            'UserProfile',
+        ]
+        zerver_test_classes_names = [
+            'Client',
+            'Message',
+            'Realm',
+            'Recipient',
+            'Stream',
+            'Subscription',
+            'UserProfile',
+        ]
+
+        # These are imported here to avoid an import cycle with
+        # zerver.lib.test_classes, which imports this module.
+        import zerver.models
+        import zerver.lib.test_helpers
+        import zerver.lib.test_classes
+
+        # Swap the state models into place with plain setattr calls,
+        # which are much cheaper than building a mock.patch.multiple
+        # patcher per module, and restore the originals when done.
+        patch_targets: List[Tuple[Any, List[str]]] = [
+            (zerver.models, zerver_models_names),
+            (zerver.lib.test_helpers, zerver_test_helpers_names),
+            (zerver.lib.test_classes, zerver_test_classes_names),
+        ]
+        saved_attrs = []
+        try:
+            for module, names in patch_targets:
+                for name in names:
+                    saved_attrs.append((module, name, getattr(module, name)))
+                    setattr(module, name, models[name])
             method(self, apps)
+        finally:
+            for module, name, old_model in saved_attrs:
+                setattr(module, name, old_model)
     return method_patched_with_mock
 
 def create_dummy_file(filename: str) -> str:
@@ -213,7 +213,7 @@ SubsuiteArgs = Tuple[Type['RemoteTestRunner'], int, SerializedSubsuite, bool]
 
 def run_subsuite(args: SubsuiteArgs) -> Tuple[int, Any]:
     # Reset the accumulated INSTRUMENTED_CALLS before running this subsuite.
-    test_helpers.INSTRUMENTED_CALLS = []
+    test_helpers.INSTRUMENTED_CALLS.clear()
     # The first argument is the test runner class but we don't need it
     # because we run our own version of the runner class.
     _, subsuite_index, subsuite, failfast = args